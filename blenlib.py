@@ -1,4 +1,7 @@
 import gdb
+import functools
+import struct
+import warnings
 
 class BlenderPrint(gdb.Command):
   def __init__ (self):
@@ -6,43 +9,155 @@ class BlenderPrint(gdb.Command):
 
   def invoke(self, arg, from_tty):
     value = gdb.parse_and_eval(arg)
-    impl = value["impl_"]
-    size = int(impl["size_"])
-    for i in range(size):
-      gdb.set_convenience_variable("a", impl)
-      sub_value = gdb.parse_and_eval(f"$a->get({i})")
+    printer = VArrayPrinter(value)
+    for sub_value in printer.get_elements(printer.get_size()):
       print(sub_value)
-      gdb.set_convenience_variable("a", None)
 
 
 BlenderPrint()
 
+# experiments.py defines get_print_elements_limit, try_read_memory and get_field_offset as well.
+# gdb sources both scripts into the same namespace, so the definitions have to behave the same.
+def get_print_elements_limit():
+  # The parameter is None or 0 when the limit is disabled.
+  limit = gdb.parameter("print elements")
+  return limit if limit else 2**31
+
+# Maps (type name, amount) to the first template arguments of that type.
+template_arguments_cache = {}
+
+def clear_template_arguments_cache(event):
+  template_arguments_cache.clear()
+
+gdb.events.new_objfile.connect(clear_template_arguments_cache)
+
+def get_template_arguments(value_type: gdb.Type, amount: int):
+  # Every template argument lookup parses the type again in gdb, but the result is the
+  # same for all values of a type.
+  key = (value_type.name, amount)
+  arguments = template_arguments_cache.get(key)
+  if arguments is None:
+    arguments = tuple(value_type.template_argument(i) for i in range(amount))
+    if value_type.name is not None:
+      template_arguments_cache[key] = arguments
+  return arguments
+
+def try_read_memory(address: int, size: int):
+  # Reading memory of the debugged program can always fail, e.g. when a container is not
+  # initialized yet. Printers show an unreadable_item then instead of failing entirely.
+  if size == 0:
+    return b""
+  try:
+    return bytes(gdb.selected_inferior().read_memory(address, size))
+  except gdb.MemoryError:
+    warnings.warn("Some memory could not be read while printing a value.")
+    return None
+
+unreadable_item = ("<unreadable>", "")
+
+bulk_readable_type_codes = {
+  gdb.TYPE_CODE_INT,
+  gdb.TYPE_CODE_FLT,
+  gdb.TYPE_CODE_PTR,
+  gdb.TYPE_CODE_BOOL,
+  gdb.TYPE_CODE_CHAR,
+  gdb.TYPE_CODE_ENUM,
+}
+
+def array_children(data: gdb.Value, size: int):
+  # Elements of primitive types are read from memory all at once. Indexing the pointer
+  # instead would read every element through gdb separately.
+  size = min(size, get_print_elements_limit())
+  element_type = data.type.target()
+  element_size = element_type.sizeof
+  if size > 0 and element_type.strip_typedefs().code in bulk_readable_type_codes:
+    buffer = try_read_memory(int(data), size * element_size)
+    if buffer is None:
+      yield unreadable_item
+      return
+    for i in range(size):
+      offset = i * element_size
+      yield str(i), gdb.Value(buffer[offset:offset + element_size], element_type)
+  else:
+    for i in range(size):
+      yield str(i), data[i]
+
 class VectorPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
+    self.begin = value["begin_"]
+    self.size = int(value["end_"] - self.begin)
 
   def to_string(self):
-    vec_begin = self.value["begin_"]
-    vec_end = self.value["end_"]
-    vec_capacity_end = self.value["end_"]
-    vec_size = vec_end - vec_begin
-    vec_capacity = vec_capacity_end - vec_begin
-    return f"Size: {vec_size}"
+    return f"Size: {self.size}"
 
   def children(self):
-    begin = self.value["begin_"]
-    end = self.value["end_"]
-    size = end - begin
-    for i in range(size):
-      yield str(i), begin[i]
+    yield from array_children(self.begin, self.size)
 
   def display_hint(self):
     return "array"
 
+def get_field(struct_type: gdb.Type, field_name: str):
+  for field in struct_type.strip_typedefs().fields():
+    if field.name == field_name:
+      return field
+  raise gdb.error(f"Type '{struct_type}' has no field '{field_name}'")
+
+def get_field_offset(struct_type: gdb.Type, field_name: str):
+  return get_field(struct_type, field_name).bitpos // 8
+
+# Amount of slots that is read from memory at once.
+slots_chunk_size = 1024
+
+def read_slot_chunks(slots: gdb.Value, slots_num: int):
+  # Slots are read in chunks, so that the slot states do not have to be accessed through gdb
+  # one by one, while a large table is not read entirely when only few elements are printed.
+  slot_size = slots.type.target().sizeof
+  for chunk_begin in range(0, slots_num, slots_chunk_size):
+    chunk_num = min(slots_chunk_size, slots_num - chunk_begin)
+    chunk_data = try_read_memory(int(slots) + chunk_begin * slot_size, chunk_num * slot_size)
+    yield chunk_begin, chunk_data
+    if chunk_data is None:
+      return
+
+def find_occupied_slots(slots: gdb.Value, slots_num: int, has_pointer_keys: bool = False):
+  # Yields None when a part of the slots cannot be read.
+  slot_type = slots.type.target()
+  slot_size = slot_type.sizeof
+  if has_pointer_keys:
+    key_field = get_field(slot_type, "key_")
+    key_offset = key_field.bitpos // 8
+    key_type = key_field.type
+    key_size = key_type.sizeof
+    # The key has two special values for an empty and a removed slot, which are the two
+    # largest values of the key type.
+    first_special_key = 2**(8 * key_size) - 2
+  else:
+    state_offset = get_field_offset(slot_type, "state_")
+  for chunk_begin, chunk_data in read_slot_chunks(slots, slots_num):
+    if chunk_data is None:
+      yield None
+      return
+    if has_pointer_keys:
+      for i in range(len(chunk_data) // slot_size):
+        key_begin = i * slot_size + key_offset
+        # Let gdb decode the key, so that the byte order of the target is respected.
+        key_int = int(gdb.Value(chunk_data[key_begin:key_begin + key_size], key_type))
+        if key_int < first_special_key:
+          yield chunk_begin + i
+    else:
+      # Gather the states of all slots into one byte string, so that runs of empty slots are
+      # skipped by bytes.find instead of being checked one by one in Python.
+      states = bytes(chunk_data[state_offset::slot_size])
+      i = states.find(1)
+      while i != -1:
+        yield chunk_begin + i
+        i = states.find(1, i + 1)
+
 class SetPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
-    self.key_type = value.type.template_argument(0)
+    self.key_type = get_template_arguments(value.type, 1)[0]
 
   def to_string(self):
     size = int(self.value["occupied_and_removed_slots_"] - self.value["removed_slots_"])
@@ -51,13 +166,22 @@ class SetPrinter:
   def children(self):
     slots = self.value["slots_"]["data_"]
     slots_num = int(self.value["slots_"]["size_"])
-    for i in range(slots_num):
-      slot = slots[i]
-      slot_state = int(slot["state_"])
-      is_occupied = slot_state == 1
-      if is_occupied:
-        key = slot["key_buffer_"].cast(self.key_type)
-        yield str(i), key
+    # Sets of pointers use slots that only store the key, like maps with pointer keys.
+    has_pointer_keys = self.key_type.code == gdb.TYPE_CODE_PTR
+    limit = get_print_elements_limit()
+    emitted = 0
+    for i in find_occupied_slots(slots, slots_num, has_pointer_keys):
+      if i is None:
+        yield unreadable_item
+        return
+      if has_pointer_keys:
+        key = slots[i]["key_"]
+      else:
+        key = slots[i]["key_buffer_"].cast(self.key_type)
+      yield str(i), key
+      emitted += 1
+      if emitted >= limit:
+        break
 
   def display_hint(self):
     return "array"
@@ -65,8 +189,7 @@ class SetPrinter:
 class MapPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
-    self.key_type = value.type.template_argument(0)
-    self.value_type = value.type.template_argument(1)
+    self.key_type, self.value_type = get_template_arguments(value.type, 2)
 
   def to_string(self):
     size = int(self.value["occupied_and_removed_slots_"] - self.value["removed_slots_"])
@@ -75,53 +198,38 @@ class MapPrinter:
   def children(self):
     slots = self.value["slots_"]["data_"]
     slots_num = int(self.value["slots_"]["size_"])
-    for i in range(slots_num):
+    has_pointer_keys = self.key_type.code == gdb.TYPE_CODE_PTR
+    limit = get_print_elements_limit()
+    emitted = 0
+    for i in find_occupied_slots(slots, slots_num, has_pointer_keys):
+      if i is None:
+        # Map children are expected to come in key/value pairs.
+        yield "Key", unreadable_item[0]
+        yield "Value", unreadable_item[1]
+        return
       slot = slots[i]
-      if self.key_type.code == gdb.TYPE_CODE_PTR:
+      if has_pointer_keys:
         key = slot["key_"]
-        key_int = int(key)
-        # The key has two special values for an empty and removed slot.
-        is_occupied = key_int < 2**64 - 2
-        if is_occupied:
-          value = slot["value_buffer_"].cast(self.value_type)
-          yield "Key", key
-          yield "Value", value
       else:
-        slot_state = int(slot["state_"])
-        is_occupied = slot_state == 1
-        if is_occupied:
-          key = slot["key_buffer_"].cast(self.key_type)
-          value = slot["value_buffer_"].cast(self.value_type)
-          yield "Key", key
-          yield "Value", value
+        key = slot["key_buffer_"].cast(self.key_type)
+      value = slot["value_buffer_"].cast(self.value_type)
+      yield "Key", key
+      yield "Value", value
+      emitted += 1
+      if emitted >= limit:
+        break
 
   def display_hint(self):
     return "map"
 
-class MultiValueMapPrinter:
-  def __init__(self, value: gdb.Value):
-    self.value = value
-    self.map_value = value["map_"]
-
-  def to_string(self):
-    return MapPrinter(self.map_value).to_string()
-
-  def children(self):
-    return MapPrinter(self.map_value).children()
-
-  def display_hint(self):
-    return MapPrinter(self.map_value).display_hint()
-
 class TypedBufferPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
-    self.type = value.type.template_argument(0)
-    self.size = value.type.template_argument(1)
+    self.type, self.size = get_template_arguments(value.type, 2)
 
   def children(self):
     data = self.value.cast(self.type).address
-    for i in range(self.size):
-      yield str(i), data[i]
+    yield from array_children(data, int(self.size))
 
   def display_hint(self):
     return "array"
@@ -129,16 +237,14 @@ class TypedBufferPrinter:
 class ArrayPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
+    self.data = value["data_"]
+    self.size = int(value["size_"])
 
   def to_string(self):
-    size = self.value["size_"]
-    return f"Size: {size}"
+    return f"Size: {self.size}"
 
   def children(self):
-    data = self.value["data_"]
-    size = self.value["size_"]
-    for i in range(size):
-      yield str(i), data[i]
+    yield from array_children(self.data, self.size)
 
   def display_hint(self):
     return "array"
@@ -146,19 +252,14 @@ class ArrayPrinter:
 class VectorSetPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
-
-  def get_size(self):
-    return int(self.value["occupied_and_removed_slots_"] - self.value["removed_slots_"])
+    self.size = int(value["occupied_and_removed_slots_"] - value["removed_slots_"])
 
   def to_string(self):
-    size = self.get_size()
-    return f"Size: {size}"
+    return f"Size: {self.size}"
 
   def children(self):
-    data = self.value["keys_"]
-    size = self.get_size()
-    for i in range(size):
-      yield str(i), data[i]
+    # The keys are stored contiguously, independent of the hash table slots.
+    yield from array_children(self.value["keys_"], self.size)
 
   def display_hint(self):
     return "array"
@@ -177,25 +278,80 @@ class VArrayPrinter:
     return f"Size: {size}"
 
   def children(self):
-    size = self.get_size()
+    size = min(self.get_size(), get_print_elements_limit())
+    for i, value_at_index in enumerate(self.get_elements(size)):
+      yield str(i), value_at_index
+
+  def get_elements(self, size):
     impl = self.value["impl_"]
+    # Read the elements directly for the common implementations, to avoid calling the
+    # virtual get method through the expression parser for every index.
+    impl_type = impl.dynamic_type
+    impl_type_name = impl_type.target().unqualified().strip_typedefs().name or ""
+    if impl_type_name.startswith("blender::VArrayImpl_For_Span"):
+      data = impl.cast(impl_type)["data_"]
+      for i in range(size):
+        yield data[i]
+      return
+    if impl_type_name.startswith("blender::VArrayImpl_For_Single<"):
+      single_value = impl.cast(impl_type)["value_"]
+      for i in range(size):
+        yield single_value
+      return
     for i in range(size):
       gdb.set_convenience_variable("varray_impl", impl)
       value_at_index = gdb.parse_and_eval(f"$varray_impl->get({i})")
       gdb.set_convenience_variable("varray_impl", None)
-      yield str(i), value_at_index
+      yield value_at_index
 
   def display_hint(self):
     return "array"
 
+# Component types that can be unpacked with the struct module and formatted in Python.
+struct_format_by_type_name = {
+  "float": "f",
+  "double": "d",
+  "short": "h",
+  "unsigned short": "H",
+  "int": "i",
+  "unsigned int": "I",
+  "long": "l",
+  "unsigned long": "L",
+  "long long": "q",
+  "unsigned long long": "Q",
+}
+
 class MathVectorPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
-    self.base_type = value.type.template_argument(0)
-    self.size = value.type.template_argument(1)
+    self.base_type, size = get_template_arguments(value.type, 2)
+    self.size = int(size)
+    self.components = self.read_components()
+
+  def read_components(self):
+    # Read all components at once instead of accessing every component through gdb.
+    address = self.value.address
+    format_char = struct_format_by_type_name.get(self.base_type.strip_typedefs().name)
+    if address is None or format_char is None:
+      return None
+    if struct.calcsize(format_char) != self.base_type.sizeof:
+      return None
+    buffer = try_read_memory(int(address), self.size * self.base_type.sizeof)
+    if buffer is None:
+      return None
+    return struct.unpack(f"{self.size}{format_char}", buffer)
+
+  def format_component(self, component):
+    if isinstance(component, float):
+      # Use the same precision as gdb.
+      return f"{component:.9g}" if self.base_type.sizeof == 4 else f"{component:.17g}"
+    return str(component)
 
   def to_string(self):
-    values = [str(self.get(i)) for i in range(self.size)]
+    if self.components is None:
+      values = [str(self.get(i)) for i in range(self.size)]
+    else:
+      values = [self.format_component(component) for component in self.components]
     return "(" + ", ".join(values) + ")"
 
   def children(self):
@@ -218,21 +374,47 @@ class MathVectorPrinter:
 class SpanPrinter:
   def __init__(self, value: gdb.Value):
     self.value = value
+    self.data = value["data_"]
+    self.size = int(value["size_"])
 
   def to_string(self):
-    size = self.value["size_"]
-    return f"Size: {size}"
+    return f"Size: {self.size}"
 
   def children(self):
-    data = self.value["data_"]
-    size = self.value["size_"]
-    for i in range(size):
-      yield str(i), data[i]
+    yield from array_children(self.data, self.size)
 
   def display_hint(self):
     return "array"
 
 
+printers_by_template_name = {
+  "Vector": VectorPrinter,
+  "Set": SetPrinter,
+  "Map": MapPrinter,
+  # The multi-value-map is displayed like the map it wraps.
+  "MultiValueMap": lambda value: MapPrinter(value["map_"]),
+  "TypedBuffer": TypedBufferPrinter,
+  "Array": ArrayPrinter,
+  "VectorSet": VectorSetPrinter,
+  "VArray": VArrayPrinter,
+  "VMutableArray": VArrayPrinter,
+  "vec_struct_base": MathVectorPrinter,
+  "Span": SpanPrinter,
+  "MutableSpan": SpanPrinter,
+}
+
+@functools.lru_cache(maxsize=None)
+def find_printer_class(type_name: str):
+  # Most values have one of only a few different template instantiations,
+  # so the decision is cached by the full type name.
+  prefix = "blender::"
+  if not type_name.startswith(prefix):
+    return None
+  template_start = type_name.find("<")
+  if template_start == -1:
+    return None
+  return printers_by_template_name.get(type_name[len(prefix):template_start])
+
 class BlenderPrettyPrinters(gdb.printing.PrettyPrinter):
   def __init__(self):
     super().__init__("blender-printers")
@@ -243,34 +425,17 @@ class BlenderPrettyPrinters(gdb.printing.PrettyPrinter):
       return None
     if value_type.code == gdb.TYPE_CODE_PTR:
       return None
+    # Reject most values before the typedef chain is resolved.
+    raw_type_name = value_type.name
+    if raw_type_name is None or not raw_type_name.startswith("blender::"):
+      return None
     type_name = value_type.strip_typedefs().name
     if type_name is None:
       return None
-    if type_name.startswith("blender::Vector<"):
-      return VectorPrinter(value)
-    if type_name.startswith("blender::Set<"):
-      return SetPrinter(value)
-    if type_name.startswith("blender::Map<"):
-      return MapPrinter(value)
-    if type_name.startswith("blender::MultiValueMap<"):
-      return MultiValueMapPrinter(value)
-    if type_name.startswith("blender::TypedBuffer<"):
-      return TypedBufferPrinter(value)
-    if type_name.startswith("blender::Array<"):
-      return ArrayPrinter(value)
-    if type_name.startswith("blender::VectorSet<"):
-      return VectorSetPrinter(value)
-    if type_name.startswith("blender::VArray<"):
-      return VArrayPrinter(value)
-    if type_name.startswith("blender::VMutableArray<"):
-      return VArrayPrinter(value)
-    if type_name.startswith("blender::vec_struct_base<"):
-      return MathVectorPrinter(value)
-    if type_name.startswith("blender::Span<"):
-      return SpanPrinter(value)
-    if type_name.startswith("blender::MutableSpan<"):
-      return SpanPrinter(value)
-    return None
+    printer_class = find_printer_class(type_name)
+    if printer_class is None:
+      return None
+    return printer_class(value)
 
 
 gdb.printing.register_pretty_printer(None, BlenderPrettyPrinters(), replace=True)
@@ -1,38 +1,71 @@
 import gdb
+import os
 from pprint import pprint
 import traceback
 import typing as t
 import functools
+import itertools
+import pickle
+import warnings
 from dataclasses import dataclass
 
 nullptr = 0x0
 
+# blenlib.py defines try_read_memory, get_field_offset and get_print_elements_limit as well.
+# gdb sources both scripts into the same namespace, so the definitions have to behave the same.
+def try_read_memory(address: int, size: int) -> t.Optional[bytes]:
+    '''Read memory of the debugged program, or return None if it is not readable.'''
+    if size == 0:
+        return b""
+    try:
+        return bytes(gdb.selected_inferior().read_memory(address, size))
+    except gdb.MemoryError:
+        warnings.warn("Some memory could not be read while printing a value.")
+        return None
+
+def read_array_bytes(value: gdb.Value) -> t.Optional[bytes]:
+    '''Read the whole array at once instead of fetching every element through gdb separately.'''
+    address = value.address
+    if address is None:
+        # The value only exists in gdb (e.g. it was created from a Python string).
+        return value.string(encoding="latin1", length=value.type.sizeof).encode("latin1")
+    return try_read_memory(int(address), value.type.sizeof)
+
 def string_from_array(value: gdb.Value):
     assert value.type.code == gdb.TYPE_CODE_ARRAY
     assert value.type.target().sizeof == 1
 
-    try:
-        str_bytes = []
-        for i in range(value.type.sizeof):
-            c = value[i]
-            if c == nullptr:
-                break
-            str_bytes.append(int(c))
-    except gdb.MemoryError:
+    str_bytes = read_array_bytes(value)
+    if str_bytes is None:
         return ""
 
-    try:
-        return bytes(str_bytes).decode('utf8')
-    except UnicodeDecodeError:
-        return "<utf8 decode error>"
+    # Replace invalid characters so that the rest of a broken name can still be displayed.
+    return str_bytes.partition(b"\x00")[0].decode('utf8', 'replace')
 
 # Some random string.
 dummy_type_prefix = "=*?="
+dummy_type_prefix_bytes = dummy_type_prefix.encode("ascii")
 
-def print_traceback(value):
+def print_traceback():
     '''Print the traceback to stdout. Otherwise it might not be printed in some cases in vscode.'''
     print(traceback.format_exc())
 
+# Set the BLENDER_GDB_DEBUG environment variable to see errors that happen in printers.
+debug_mode = bool(os.environ.get("BLENDER_GDB_DEBUG"))
+
+def print_exceptions_in_debug_mode(generator_function):
+    '''Print tracebacks of exceptions in the generator instead of passing them on to gdb.'''
+    if not debug_mode:
+        return generator_function
+
+    @functools.wraps(generator_function)
+    def wrapper(*args, **kwargs):
+        try:
+            yield from generator_function(*args, **kwargs)
+        except Exception:
+            print(traceback.format_exc())
+    return wrapper
+
 @dataclass
 class DummyValue:
     pass
@@ -45,49 +78,46 @@ class JustText(DummyValue):
         return self.text
 
 def make_dummy_value_printer(value):
-    value_str = repr(value)
-    return gdb.Value(dummy_type_prefix + value_str)
+    # The pickled value is hex encoded, because gdb.Value does not support null bytes in strings.
+    return gdb.Value(dummy_type_prefix + pickle.dumps(value).hex())
 
 def extract_dummy_value_printer(value: gdb.Value):
     if value.type.code != gdb.TYPE_CODE_ARRAY:
         return None
+    if value.address is not None:
+        # Dummy values are created by gdb.Value and never live in the inferior's memory,
+        # so char arrays of the debugged program don't have to be read at all.
+        return None
     if value.type.sizeof < len(dummy_type_prefix):
         return None
     if value.type.target().sizeof != 1:
         # Expected char type.
         return None
 
-    try:
-        for i in range(len(dummy_type_prefix)):
-            if ord(dummy_type_prefix[i]) != value[i]:
-                # Prefix did not match.
-                return None
-    except gdb.MemoryError:
+    str_bytes = read_array_bytes(value)
+    if str_bytes is None:
         return None
 
-    try:
-        str_bytes = []
-        for i in range(len(dummy_type_prefix), value.type.sizeof):
-            str_bytes.append(int(value[i]))
-    except gdb.MemoryError:
-        return None
-
-    try:
-        value_str = bytes(str_bytes).decode("utf8")
-    except UnicodeDecodeError:
-        # Most likely the memory is corrupted.
+    if not str_bytes.startswith(dummy_type_prefix_bytes):
         return None
+    str_bytes = str_bytes[len(dummy_type_prefix_bytes):].partition(b"\x00")[0]
 
     try:
-        dummy_value = eval(value_str)
+        dummy_value = pickle.loads(bytes.fromhex(str_bytes.decode("ascii")))
     except:
         print_traceback()
         return None
 
     return dummy_value
 
+# Keys for list elements, so that they don't have to be formatted for every element.
+index_keys = tuple(f"[{i}]" for i in range(1024))
+
 def make_debug_item(key: t.Union[int, str], value: t.Union[str, int, bool, float, gdb.Value, DummyValue]):
-    key = f"[{str(key)}]"
+    if isinstance(key, int) and 0 <= key < len(index_keys):
+        key = index_keys[key]
+    else:
+        key = f"[{str(key)}]"
     if isinstance(value, str):
         value = JustText(value)
     if isinstance(value, DummyValue):
@@ -95,116 +125,280 @@ def make_debug_item(key: t.Union[int, str], value: t.Union[str, int, bool, float
     return key, value
 
 def make_address_item(value: gdb.Value):
-    return make_debug_item("Address", hex(value.address))
-
-def make_raw_field_items(value: gdb.Value):
-    for field in value.type.fields():
-        yield field.name, value[field.name]
+    # Values that are not stored in memory of the inferior (e.g. function results) have no address.
+    if value.address is None:
+        return make_debug_item("Address", "<none>")
+    return make_debug_item("Address", hex(int(value.address)))
+
+def get_displayed_fields(fields: t.Sequence[gdb.Field]):
+    '''Filter out fields that are not interesting when looking at a struct.'''
+    displayed_fields = []
+    for field in fields:
+        if field.artificial:
+            # E.g. the vtable pointer.
+            continue
+        if field.name is None and field.bitsize != 0:
+            # Unnamed bit-fields are only used for padding.
+            continue
+        displayed_fields.append(field)
+    return tuple(displayed_fields)
+
+def get_struct_fields(value_type: gdb.Type) -> t.Tuple[gdb.Field, ...]:
+    try:
+        return tuple(value_type.fields())
+    except TypeError:
+        # The type has no fields, e.g. because it is a typedef of a primitive type.
+        return ()
+
+def has_id_first_field(fields: t.Sequence[gdb.Field]) -> bool:
+    '''All ID types (Object, Mesh, ...) start with an ID struct.'''
+    return len(fields) >= 1 and fields[0].name == "id" and fields[0].type.name == "ID"
+
+def make_raw_field_items(value: gdb.Value, fields: t.Sequence[gdb.Field]):
+    for field in itertools.islice(fields, get_print_elements_limit()):
+        if field.name is None:
+            # Anonymous struct or union members can only be accessed with the field itself.
+            yield "<anonymous>", value[field]
+        else:
+            yield field.name, value[field.name]
 
 registered_struct_printers = {}
 
-def struct_printer(function):
+def struct_printer(function=None, *, raw_fields: bool = True):
+    '''Register a printer. With raw_fields=False, the struct fields are not listed after the printed items.'''
+    if function is None:
+        return lambda function: struct_printer(function, raw_fields=raw_fields)
     prefix = "print_"
     function_name = function.__name__
     if not function_name.startswith(prefix):
         raise Exception()
     struct_name = function_name[len(prefix):]
+    function.raw_fields = raw_fields
     registered_struct_printers[struct_name] = function
     return function
 
 @struct_printer
 def print_ID(value: gdb.Value):
-    yield "Name", string_from_array(value["name"])
+    yield "Name", get_id_name(value)
+
+def get_id_name(value: gdb.Value):
+    return string_from_array(value["name"])
+
+objfile_caches = []
+
+def objfile_cache(function):
+    '''Memoize a function whose result only depends on the loaded debug symbols.'''
+    cached_function = functools.lru_cache(maxsize=None)(function)
+    objfile_caches.append(cached_function)
+    return cached_function
 
-@functools.lru_cache
-def lookup_enum_value(name: str):
+def clear_objfile_caches(event):
+    for cached_function in objfile_caches:
+        cached_function.cache_clear()
+
+gdb.events.new_objfile.connect(clear_objfile_caches)
+
+@objfile_cache
+def get_enum_values(enum_type_name: str):
+    '''Get all enumerators of an enum type at once.'''
+    try:
+        enum_type = gdb.lookup_type(enum_type_name).strip_typedefs()
+    except gdb.error:
+        return {}
+    return {field.name: field.enumval for field in enum_type.fields()}
+
+@objfile_cache
+def lookup_enum_value(name: str, enum_type_name: t.Optional[str] = None):
+    if enum_type_name is not None:
+        enum_value = get_enum_values(enum_type_name).get(name)
+        if enum_value is not None:
+            return enum_value
     return int(gdb.lookup_global_symbol(name).value())
 
-@functools.lru_cache
-def lookup_type(name: str):
+@objfile_cache
+def lookup_type(name: str) -> t.Optional[gdb.Type]:
+    '''Returns None if the type does not exist. That result is cached as well.'''
     base_name = name.replace("*", "").strip()
-    base_type = gdb.lookup_global_symbol(base_name).type
+    try:
+        base_type = gdb.lookup_type(base_name)
+    except gdb.error:
+        symbol = gdb.lookup_global_symbol(base_name)
+        if symbol is None:
+            return None
+        base_type = symbol.type
     for _ in range(name.count("*")):
         base_type = base_type.pointer()
     return base_type
 
+def lookup_existing_type(name: str) -> gdb.Type:
+    found_type = lookup_type(name)
+    if found_type is None:
+        raise gdb.error(f"Could not find type '{name}'")
+    return found_type
+
 def cast(value: gdb.Value, type_name: str) -> gdb.Value:
-    return value.cast(lookup_type(type_name))
+    return value.cast(lookup_existing_type(type_name))
 
 def reinterpret_cast(value: gdb.Value, type_name: str) -> gdb.Value:
-    return value.reinterpret_cast(lookup_type(type_name))
+    return value.reinterpret_cast(lookup_existing_type(type_name))
 
+object_type_enum_name = "ObjectType"
 object_types = [
     ("OB_MESH", "Mesh"),
     ("OB_LAMP", "Light"),
     ("OB_CAMERA", "Camera"),
 ]
 
+@objfile_cache
+def get_object_data_types():
+    '''Maps the object type enum values to the pointer type and name of the object data.'''
+    data_types = {}
+    for enum_name, type_name in object_types:
+        data_type = lookup_type(type_name + "*")
+        if data_type is not None:
+            data_types[lookup_enum_value(enum_name, object_type_enum_name)] = (data_type, type_name)
+    return data_types
+
 @struct_printer
 def print_Object(value: gdb.Value):
-    yield from print_ID(value["id"])
+    yield "Name", get_id_name(value["id"])
     object_type = int(value["type"])
 
-    for enum_name, type_name in object_types:
-        if object_type == lookup_enum_value(enum_name):
-            yield f"{type_name} Data", cast(value["data"], type_name + "*")
-            break
-    else:
+    data_type_info = get_object_data_types().get(object_type)
+    if data_type_info is None:
         yield "Data", value["data"]
+    else:
+        data_type, type_name = data_type_info
+        yield f"{type_name} Data", value["data"].cast(data_type)
 
 @struct_printer
 def print_wmOperator(value: gdb.Value):
     yield "Idname", string_from_array(value["idname"])
 
-def get_pointer_chain(first: gdb.Value, pointer_name: str):
-    elements = []
-    elements_set = set()
-    element = first
-    while True:
-        if element == nullptr:
-            break
-        if element in elements_set:
-            break
-        elements.append(element)
-        elements_set.add(element)
-        element = element[pointer_name]
-    return elements
+def get_print_elements_limit():
+    # Same as in blenlib.py, see try_read_memory.
+    # The parameter is None or 0 when the limit is disabled.
+    limit = gdb.parameter("print elements")
+    return limit if limit else 2**31
 
-def get_full_double_linked_list(any_link: gdb.Value):
-    previous_elements = get_pointer_chain(any_link, "prev")
-    next_elements = get_pointer_chain(any_link, "next")
-    return previous_elements[::-1] + next_elements[1:]
+class MaxLinksParameter(gdb.Parameter):
+    '''Maximum number of links that are followed when printing linked lists.'''
 
-def get_listbase_elements(listbase: gdb.Value):
-    first = cast(listbase["first"], "LinkData *")
-    return get_pointer_chain(first, "next")
+    set_doc = "Set the maximum number of linked list elements that are printed."
+    show_doc = "Show the maximum number of linked list elements that are printed."
+
+    def __init__(self):
+        super().__init__("blender-printer-max-links", gdb.COMMAND_DATA, gdb.PARAM_ZUINTEGER_UNLIMITED)
+        # 0 uses the 'print elements' limit and "unlimited" (-1) follows all links.
+        self.value = 0
+
+max_links_parameter = MaxLinksParameter()
+
+def get_max_links():
+    max_links = max_links_parameter.value
+    if max_links == 0:
+        return get_print_elements_limit()
+    if max_links == -1:
+        return 2**31
+    return max_links
+
+def get_field_offset(struct_type: gdb.Type, field_name: str) -> int:
+    # Same as in blenlib.py, see try_read_memory.
+    for field in struct_type.strip_typedefs().fields():
+        if field.name == field_name:
+            return field.bitpos // 8
+    raise gdb.error(f"Type '{struct_type}' has no field '{field_name}'")
+
+def get_pointer_chain_addresses(first: gdb.Value, pointer_name: str, limit: int = 2**31):
+    '''Returns the addresses of the links and whether the chain stopped at an unreadable link.'''
+    # The links are followed by reading the pointers from memory directly, which avoids
+    # creating a gdb.Value for every field access.
+    pointer_type = first.type
+    pointer_size = pointer_type.sizeof
+    pointer_offset = get_field_offset(pointer_type.strip_typedefs().target(), pointer_name)
+    inferior = gdb.selected_inferior()
+    addresses = []
+    # Compare plain addresses, because gdb.Value is hashed by identity and not by the pointer value.
+    visited_addresses = set()
+    address = int(first)
+    while len(addresses) < limit and address != nullptr:
+        if address in visited_addresses:
+            break
+        try:
+            pointer_bytes = inferior.read_memory(address + pointer_offset, pointer_size)
+        except gdb.MemoryError:
+            # Keep the links found so far instead of failing for the entire chain.
+            return addresses, True
+        # A link is only added once its pointer could be read.
+        addresses.append(address)
+        visited_addresses.add(address)
+        # Let gdb decode the pointer, so that the byte order of the target is respected.
+        address = int(gdb.Value(pointer_bytes, pointer_type))
+    return addresses, False
+
+# The head of a double linked list is searched at most this many links before the given link.
+max_links_to_list_head = 10_000
+
+def get_full_double_linked_list(any_link: gdb.Value, limit: int = 2**31):
+    '''Returns up to limit links from the head of the list, whether links were left out and
+    whether an unreadable link was found.'''
+    previous_addresses, has_unreadable_prev = get_pointer_chain_addresses(
+        any_link, "prev", max_links_to_list_head + 1)
+    if not previous_addresses:
+        return [], False, has_unreadable_prev
+    is_head_found = not has_unreadable_prev and len(previous_addresses) <= max_links_to_list_head
+    # In a circular list, the walk stops before it reaches a link again, so the list is
+    # shown starting right after the given link.
+    head_address = previous_addresses[:max_links_to_list_head][-1]
+    head = gdb.Value(head_address).cast(any_link.type)
+    addresses, has_unreadable_next = get_pointer_chain_addresses(head, "next", limit + 1)
+    is_truncated = not is_head_found or len(addresses) > limit
+    links = [gdb.Value(address).cast(any_link.type) for address in addresses[:limit]]
+    return links, is_truncated, has_unreadable_prev or has_unreadable_next
 
 @dataclass
 class TypedListBase(DummyValue):
     any_link_address: int
     data_type: str
 
+    @print_exceptions_in_debug_mode
     def children(self):
         try:
             any_link = reinterpret_cast(gdb.Value(self.any_link_address), self.data_type + "*")
-            all_links = get_full_double_linked_list(any_link)
-            yield from (make_debug_item(i, link) for i, link in enumerate(all_links))
-        except Exception as e:
-            if isinstance(e, GeneratorExit):
-                raise
-            print(traceback.format_exc())
-
-@struct_printer
+            all_links, is_truncated, has_unreadable_link = get_full_double_linked_list(
+                any_link, get_max_links())
+        except gdb.error as e:
+            # Only this list is not printed, the rest of the value still is.
+            warnings.warn(f"Could not print linked list: {e}")
+            return
+        yield from (make_debug_item(i, link) for i, link in enumerate(all_links))
+        if is_truncated:
+            yield make_debug_item("...", "<more links not shown>")
+        if has_unreadable_link:
+            yield make_debug_item("...", "<unreadable link>")
+
+@struct_printer(raw_fields=False)
 def print_ListBase(listbase: gdb.Value):
-    try:
-        links = get_listbase_elements(listbase)
-    except gdb.MemoryError:
+    limit = get_max_links()
+    first = cast(listbase["first"], "LinkData *")
+    # One more link than displayed is followed to know whether the list is longer than the limit.
+    addresses, has_unreadable_link = get_pointer_chain_addresses(first, "next", limit + 1)
+
+    if has_unreadable_link and not addresses:
         yield "Length", "<memory error>"
         return
-
-    yield "Length", len(links)
-    for i, link in enumerate(links):
-        yield i, str(link)
+    if has_unreadable_link:
+        yield "Length", f">= {len(addresses)} (unreadable link)"
+    elif len(addresses) > limit:
+        yield "Length", f"> {limit}"
+    else:
+        yield "Length", len(addresses)
+    # The links are yielded as values, so that they can still be expanded without the raw fields.
+    for i, address in enumerate(addresses[:limit]):
+        yield i, gdb.Value(address).cast(first.type)
+    if len(addresses) > limit:
+        # The last link is not part of the displayed links then.
+        yield "Last", listbase["last"]
 
 @struct_printer
 def print_ModifierData(modifier: gdb.Value):
@@ -217,59 +411,79 @@ def print_bConstraint(constraint: gdb.Value):
     yield "Name", string_from_array(constraint["name"])
 
 class SimpleStructPrinter:
-    def __init__(self, value: gdb.Value, printer):
+    def __init__(self, value: gdb.Value, printer, fields: t.Sequence[gdb.Field]):
         self.value = value
         self.printer = printer
+        self.fields = fields
 
+    @print_exceptions_in_debug_mode
     def children(self):
-        try:
-            yield make_address_item(self.value)
-            for key, value in self.printer(self.value):
-                yield make_debug_item(key, value)
-            yield from make_raw_field_items(self.value)
-        except Exception as e:
-            if isinstance(e, GeneratorExit):
-                raise
-            print(traceback.format_exc())
+        yield make_address_item(self.value)
+        for key, value in self.printer(self.value):
+            yield make_debug_item(key, value)
+        yield from make_raw_field_items(self.value, self.fields)
 
 class GenericIDPrinter:
-    def __init__(self, value: gdb.Value):
+    def __init__(self, value: gdb.Value, fields: t.Sequence[gdb.Field]):
         self.value = value
+        self.fields = fields
 
+    @print_exceptions_in_debug_mode
     def children(self):
-        try:
-            yield make_address_item(self.value)
-            for key, value in print_ID(self.value["id"]):
-                yield make_debug_item(key, value)
-            yield from make_raw_field_items(self.value)
-        except Exception as e:
-            if isinstance(e, GeneratorExit):
-                raise
-            print(traceback.format_exc())
+        yield make_address_item(self.value)
+        yield make_debug_item("Name", get_id_name(self.value["id"]))
+        yield from make_raw_field_items(self.value, self.fields)
 
 
 class BlenderPrettyPrinter(gdb.printing.PrettyPrinter):
     def __init__(self):
         super().__init__("blender_printer", [])
+        # Maps (type name, type code) to a function that creates the printer for a value.
+        self.printer_factory_cache = {}
+        gdb.events.new_objfile.connect(self.clear_cache)
+
+    def clear_cache(self, event=None):
+        self.printer_factory_cache.clear()
 
     def lookup_printer(self, value: gdb.Value):
-        if value.type is None:
+        value_type = value.type
+        if value_type is None:
+            return None
+        type_code = value_type.code
+        if type_code == gdb.TYPE_CODE_PTR:
             return None
-        if value.type.code == gdb.TYPE_CODE_PTR:
+        if type_code == gdb.TYPE_CODE_ARRAY:
+            # Only arrays can be dummy values, and no other printers are registered for arrays.
+            return extract_dummy_value_printer(value)
+        type_name = value_type.name
+        if type_name is None:
+            # Printers are only registered for named types.
             return None
-        dummy_value_printer = extract_dummy_value_printer(value)
-        if dummy_value_printer is not None:
-            return dummy_value_printer
-        if value.type.code == gdb.TYPE_CODE_TYPEDEF:
-            if value.type.name is not None:
-                if value.type.name in registered_struct_printers:
-                    return SimpleStructPrinter(value, registered_struct_printers[value.type.name])
-                try: fields = value.type.fields()
-                except: fields = []
-                if len(fields) >= 1 and fields[0].name == "id" and fields[0].type.name == "ID":
-                    return GenericIDPrinter(value)
-        if value.type.name in registered_struct_printers:
-            return SimpleStructPrinter(value, registered_struct_printers[value.type.name])
+        printer_factory = self.printer_factory_cache.get((type_name, type_code))
+        if printer_factory is None:
+            printer_factory = self.find_printer_factory(value_type)
+            self.printer_factory_cache[(type_name, type_code)] = printer_factory
+        return printer_factory(value)
+
+    def find_printer_factory(self, value_type: gdb.Type):
+        '''Decide which printer to use for a type. This only depends on the type, so it can be cached.'''
+        # The fields are only looked up once per type and are shared by all printers of that type.
+        printer = registered_struct_printers.get(value_type.name)
+        if printer is None and value_type.code == gdb.TYPE_CODE_TYPEDEF:
+            # Typedefs can have a different name than the struct they refer to.
+            printer = registered_struct_printers.get(value_type.strip_typedefs().name)
+        if printer is not None:
+            if printer.raw_fields:
+                displayed_fields = get_displayed_fields(get_struct_fields(value_type))
+            else:
+                displayed_fields = ()
+            return lambda value: SimpleStructPrinter(value, printer, displayed_fields)
+        if value_type.code in (gdb.TYPE_CODE_TYPEDEF, gdb.TYPE_CODE_STRUCT):
+            fields = get_struct_fields(value_type)
+            if has_id_first_field(fields):
+                displayed_fields = get_displayed_fields(fields)
+                return lambda value: GenericIDPrinter(value, displayed_fields)
+        return lambda value: None
 
     def __call__(self, value: gdb.Value):
         try:
@@ -96,6 +96,9 @@ class Field:
     parent_type: Type
 
 class Value:
+    def __init__(self, val, type: t.Optional[Type] = None):
+        pass
+
     type: Type
     address: t.Optional[Value]
     is_optimized_out: bool
@@ -132,9 +135,27 @@ class Value:
     def reinterpret_cast(self, type: Type) -> Value:
         pass
 
-    def __getitem__(self, subscript: t.Union[int, str]) -> Value:
+    def __getitem__(self, subscript: t.Union[int, str, Field]) -> Value:
+        pass
+
+
+class Inferior:
+    num: int
+    pid: int
+    was_attached: bool
+
+    def read_memory(self, address: int, length: int) -> memoryview:
         pass
 
+    def write_memory(self, address: int, buffer, length=None):
+        pass
+
+    def search_memory(self, address: int, length: int, pattern) -> t.Optional[int]:
+        pass
+
+
+def selected_inferior() -> Inferior:
+    pass
 
 def lookup_type(name: str, block=None) -> Type:
     pass
@@ -145,6 +166,9 @@ def lookup_global_symbol(name: str):
 def execute(command: str, from_tty=None, to_string=None):
     pass
 
+def parameter(parameter: str) -> t.Any:
+    pass
+
 def parse_and_eval(expression: str) -> Value:
     pass
 
@@ -154,7 +178,27 @@ def set_convenience_variable(name: str, value: Value):
 def convenience_variable(name: str) -> Value | None:
     pass
 
-class MemoryError(Exception):
+class EventRegistry:
+    def connect(self, handler: t.Callable):
+        pass
+
+    def disconnect(self, handler: t.Callable):
+        pass
+
+class events:
+    stop: EventRegistry
+    cont: EventRegistry
+    exited: EventRegistry
+    new_objfile: EventRegistry
+    clear_objfiles: EventRegistry
+    memory_changed: EventRegistry
+    register_changed: EventRegistry
+    before_prompt: EventRegistry
+
+class error(RuntimeError):
+    pass
+
+class MemoryError(error):
     pass
 
 class Command:
@@ -188,6 +232,37 @@ COMMAND_USER: CommandCode
 COMMAND_OBSCURE: CommandCode
 COMMAND_MAINTENANCE: CommandCode
 
+# Does not actually exist.
+class ParameterCode:
+    pass
+
+PARAM_BOOLEAN: ParameterCode
+PARAM_AUTO_BOOLEAN: ParameterCode
+PARAM_UINTEGER: ParameterCode
+PARAM_INTEGER: ParameterCode
+PARAM_STRING: ParameterCode
+PARAM_STRING_NOESCAPE: ParameterCode
+PARAM_OPTIONAL_FILENAME: ParameterCode
+PARAM_FILENAME: ParameterCode
+PARAM_ZINTEGER: ParameterCode
+PARAM_ZUINTEGER: ParameterCode
+PARAM_ZUINTEGER_UNLIMITED: ParameterCode
+PARAM_ENUM: ParameterCode
+
+class Parameter:
+    value: t.Any
+    set_doc: str
+    show_doc: str
+
+    def __init__(self, name: str, command_class: CommandCode, parameter_class: ParameterCode, enum_sequence=None):
+        pass
+
+    def get_set_string(self) -> str:
+        pass
+
+    def get_show_string(self, svalue: str) -> str:
+        pass
+
 # Does not actually exist.
 class CompleteCode:
     pass